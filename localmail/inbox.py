@@ -15,9 +15,14 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 
+import base64
+import quopri
 import random
-import email
-from email.header import decode_header
+import re
+import threading
+from bisect import bisect_left, bisect_right
+from collections import deque
+from email.header import Header, decode_header
 import mailbox
 import email.utils
 from itertools import count
@@ -25,33 +30,94 @@ try:
     from cStringIO import StringIO
 except ImportError:
     from io import BytesIO as StringIO
+try:
+    from email import message_from_bytes
+except ImportError:
+    from email import message_from_string as message_from_bytes
 
 from zope.interface import implementer
 
+from twisted.internet import reactor
 from twisted.mail import imap4
 from twisted.python import log
 
-UID_GENERATOR = count()
-LAST_UID = next(UID_GENERATOR)
-
 SEEN = r'\Seen'
 UNSEEN = r'\Unseen'
 DELETED = r'\Deleted'
 FLAGGED = r'\Flagged'
 ANSWERED = r'\Answered'
 RECENT = r'\Recent'
+SUPPORTED_FLAGS = (SEEN, UNSEEN, DELETED, FLAGGED, ANSWERED, RECENT)
+
+_MISSING = object()
+_CHARSET_RE = re.compile(r'charset\s*=\s*"?([^";\s]+)"?', re.IGNORECASE)
+# RFC 2047 encoded word: =?charset?encoding?text?=
+_ENCODED_WORD_RE = re.compile(r'=\?([^?\s]+)\?([QqBb])\?([!->@-~]*)\?=')
+
+
+class UIDCounter(object):
+    "hands out ascending uids, and remembers the last one"
+
+    __slots__ = ('_uids', '_last')
+
+    def __init__(self):
+        self._uids = count(1)
+        self._last = 0
+
+    def next(self):
+        self._last = next(self._uids)
+        return self._last
+
+    def peek(self):
+        return self._last
+
+
+UID_GENERATOR = UIDCounter()
 
 
 def get_counter():
-    global LAST_UID
-    LAST_UID = next(UID_GENERATOR)
-    return LAST_UID
+    return UID_GENERATOR.next()
+
+
+def _decode_word(charset, encoding, text):
+    text = text.encode('ascii')
+    if encoding in 'Bb':
+        # be lenient about missing padding, like email.header is
+        text += b'=' * (-len(text) % 4)
+        decoded = base64.b64decode(text)
+    else:
+        decoded = quopri.decodestring(text, header=True)
+    # drop any RFC 2231 language suffix, e.g. utf-8*en
+    return decoded.decode(charset.split('*')[0], 'replace')
+
+
+def _decode_header(value):
+    "decode the RFC 2047 encoded words in a header value"
+    parts = []
+    end = 0
+    for match in _ENCODED_WORD_RE.finditer(value):
+        literal = value[end:match.start()]
+        # whitespace between two encoded words is not part of the text
+        if not (end and literal.isspace()):
+            parts.append(literal)
+        try:
+            parts.append(_decode_word(*match.groups()))
+        except (LookupError, ValueError):
+            # unknown charset or broken encoding, leave the word alone
+            parts.append(match.group(0))
+        end = match.end()
+    parts.append(value[end:])
+    return u''.join(
+        part.decode('ascii', 'replace') if isinstance(part, bytes) else part
+        for part in parts)
 
 
 @implementer(imap4.IMailbox)
 class MemoryIMAPMailbox(object):
 
     mbox = None
+    # seconds to wait for more messages before flushing the mbox file
+    flush_delay = 0.2
 
     def addMessage(self, msg_fp, flags=None, date=None):
         if flags is None:
@@ -59,53 +125,120 @@ class MemoryIMAPMailbox(object):
         if date is None:
             date = email.utils.formatdate()
         msg = Message(msg_fp, flags, date)
-        if self.mbox is not None:
-            self.mbox.add(msg.msg)
         self.msgs.append(msg)
-        self.flush()
+        self._uid_index[msg.uid] = len(self.msgs) - 1
+        self._uids.append(msg.uid)
+        self._count_flags(msg.flags, 1)
+        self.new_message.set()
+        self._schedule_flush(msg)
 
     def setFile(self, path):
         log.msg("creating mbox file %s" % path)
         self.mbox = mailbox.mbox(path)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.flush)
+
+    def _schedule_flush(self, msg):
+        "write msg soon, so that a burst of messages is written in one go"
+        if self.mbox is None:
+            return
+        self._unwritten.append(msg)
+        if self._delayed_flush is None:
+            self._delayed_flush = reactor.callLater(
+                self.flush_delay, self.flush)
 
     def flush(self):
-        if self.mbox is not None:
+        if self._delayed_flush is not None:
+            if self._delayed_flush.active():
+                self._delayed_flush.cancel()
+            self._delayed_flush = None
+        if self.mbox is not None and self._unwritten:
             log.msg("flushing mailbox")
-            self.mbox.flush()
+            # one lock and one sync for the whole batch
+            self.mbox.lock()
+            try:
+                # add() writes straight to the file, so only drop each
+                # message once it is there, a retry must not repeat it
+                while self._unwritten:
+                    self.mbox.add(self._unwritten[0].msg)
+                    self._unwritten.popleft()
+                self.mbox.flush()
+            finally:
+                self.mbox.unlock()
 
     def __init__(self):
         # can't use OrderedDict as need to support 2.6 :(
         self.msgs = []
+        # uid -> position in self.msgs
+        self._uid_index = {}
+        # uids in the same (ascending) order as self.msgs
+        self._uids = []
         self.listeners = []
+        # set on every delivery, lets in-process tests wait for a message
+        self.new_message = threading.Event()
         self.uidvalidity = random.randint(1000000, 9999999)
+        # clients poll STATUS a lot, so keep these up to date rather than
+        # scanning every message
+        self._recent_count = 0
+        self._unseen_count = 0
+        # messages not yet written to the mbox file
+        self._unwritten = deque()
+        self._delayed_flush = None
+
+    def _count_flags(self, flags, delta):
+        if RECENT in flags:
+            self._recent_count += delta
+        if UNSEEN in flags:
+            self._unseen_count += delta
 
     def _get_msgs(self, msg_set, uid):
         if not self.msgs:
             return {}
         if uid:
-            msg_set.last = LAST_UID
-            uids = set(msg_set)
-            return dict((i, msg) for i, msg in enumerate(self.msgs)
-                        if msg.uid in uids)
+            msg_set.last = UID_GENERATOR.peek()
+            if len(msg_set) == 1:
+                # a single message, the usual case when a client syncs
+                i = self._uid_index.get(msg_set.ranges[0][0])
+                return {} if i is None else {i: self.msgs[i]}
+            if len(msg_set) > len(self.msgs):
+                # e.g. 1:*, find the run of messages in each range by
+                # bisecting the sorted uids instead
+                msgs = {}
+                for low, high in msg_set.ranges:
+                    start = bisect_left(self._uids, low)
+                    end = bisect_right(self._uids, high)
+                    msgs.update(enumerate(self.msgs[start:end], start))
+                return msgs
+            index = self._uid_index
+            return dict((index[uid], self.msgs[index[uid]])
+                        for uid in msg_set if uid in index)
         else:
             msg_set.last = len(self.msgs)
-            return dict((i, self.msgs[i - 1]) for i in msg_set)
+            # ranges are sorted, so only the last one can run off the end
+            if msg_set.ranges[-1][1] > len(self.msgs):
+                raise imap4.MailboxException(
+                    "Invalid message sequence number")
+            # slice each range out rather than iterating number by number
+            msgs = {}
+            for low, high in msg_set.ranges:
+                low = max(low, 1)
+                msgs.update(enumerate(self.msgs[low - 1:high], low))
+            return msgs
 
     def getHierarchicalDelimiter(self):
         return "."
 
     def getFlags(self):
-        "return list of flags supported by this mailbox"
-        return [SEEN, UNSEEN, DELETED, FLAGGED, ANSWERED, RECENT]
+        "return flags supported by this mailbox"
+        return SUPPORTED_FLAGS
 
     def getMessageCount(self):
         return len(self.msgs)
 
     def getRecentCount(self):
-        return len([m for m in self.msgs if RECENT in m.getFlags()])
+        return self._recent_count
 
     def getUnseenCount(self):
-        return len([m for m in self.msgs if UNSEEN in m.getFlags()])
+        return self._unseen_count
 
     def isWriteable(self):
         return True
@@ -117,7 +250,7 @@ class MemoryIMAPMailbox(object):
         return self.msgs[messageNum - 1].uid
 
     def getUIDNext(self):
-        return LAST_UID + 1
+        return UID_GENERATOR.peek() + 1
 
     def fetch(self, msg_set, uid):
         messages = self._get_msgs(msg_set, uid)
@@ -136,28 +269,34 @@ class MemoryIMAPMailbox(object):
 
     def store(self, msg_set, flags, mode, uid):
         messages = self._get_msgs(msg_set, uid)
+        flags = frozenset(flags)
         setFlags = {}
         for seq, msg in messages.items():
+            self._count_flags(msg.flags, -1)
             if mode == 0:  # replace flags
                 msg.flags = set(flags)
-            else:
-                for flag in flags:
-                    # mode 1 is append, mode -1 is delete
-                    if mode == 1 and flag not in msg.flags:
-                        msg.flags.add(flag)
-                    elif mode == -1 and flag in msg.flags:
-                        msg.flags.remove(flag)
+            elif mode == 1:  # append
+                msg.flags |= flags
+            else:  # delete
+                msg.flags -= flags
+            self._count_flags(msg.flags, 1)
             setFlags[seq] = msg.flags
         return setFlags
 
     def expunge(self):
         "remove all messages marked for deletion"
         removed = []
-        for i, msg in enumerate(self.msgs[:]):
+        kept = []
+        for msg in self.msgs:
             if DELETED in msg.flags:
-                # use less efficient remove() because the indexes are changing
-                self.msgs.remove(msg)
+                self._count_flags(msg.flags, -1)
                 removed.append(msg.uid)
+            else:
+                kept.append(msg)
+        # replace the contents in one go, keeping the same list object
+        self.msgs[:] = kept
+        self._uid_index = dict((msg.uid, i) for i, msg in enumerate(kept))
+        self._uids = [msg.uid for msg in kept]
         self.flush()
         return removed
 
@@ -172,19 +311,35 @@ INBOX = MemoryIMAPMailbox()
 @implementer(imap4.IMessagePart)
 class MessagePart(object):
 
+    # there can be a lot of these held in memory, so don't give each a dict
+    __slots__ = ('msg', '_size', '_charset', '_headers', '_body')
+
     def __init__(self, msg):
         self.msg = msg
+        self._size = None
+        self._charset = _MISSING
+        self._headers = None
+        self._body = None
+
+    def _lower_headers(self):
+        if self._headers is None:
+            headers = {}
+            for header in self.msg.keys():
+                key = header.lower()
+                if key not in headers:
+                    headers[key] = self.msg.get(header, '')
+            self._headers = headers
+        return self._headers
 
     def getHeaders(self, negate, *names):
-        headers = {}
+        all_headers = self._lower_headers()
         if negate:
-            for header in self.msg.keys():
-                if header.upper() not in names:
-                    headers[header.lower()] = self.msg.get(header, '')
-        else:
-            for name in names:
-                headers[name.lower()] = self.msg.get(name, '')
-        return headers
+            names = frozenset(name.lower() for name in names)
+            return dict((header, value)
+                        for header, value in all_headers.items()
+                        if header not in names)
+        return dict((name.lower(), all_headers.get(name.lower(), ''))
+                    for name in names)
 
     def getBodyFile(self):
         if self.msg.is_multipart():
@@ -195,13 +350,18 @@ class MessagePart(object):
         # any Content-Transfer-Encoding, which would be tedious to recreate
         # so we access the private field. This may cause issues in future.
         # ¯\_(ツ)_/¯
-        payload = self.msg._payload
-        if not isinstance(payload, bytes):
-            payload = payload.encode('ascii', 'surrogateescape')
-        return StringIO(payload)
+        if self._body is None:
+            payload = self.msg._payload
+            if not isinstance(payload, bytes):
+                payload = payload.encode('ascii', 'surrogateescape')
+            self._body = payload
+        # the file shares the cached bytes until it is written to
+        return StringIO(self._body)
 
     def getSize(self):
-        return len(self.msg.as_string())
+        if self._size is None:
+            self._size = len(self.msg.as_string())
+        return self._size
 
     def isMultipart(self):
         return self.msg.is_multipart()
@@ -212,37 +372,54 @@ class MessagePart(object):
         raise TypeError("Not a multipart message")
 
     def parse_charset(self, default='utf8'):
+        if self._charset is _MISSING:
+            self._charset = self._find_charset()
+        if self._charset is None:
+            return default
+        return self._charset
+
+    def _find_charset(self):
         charset = self.msg.get_charset()
         if charset is not None:
             return charset
 
-        for chunk in self.msg['Content-type'].split(';'):
-            if 'charset' in chunk:
-                return chunk.split('=')[1]
-        return default
+        content_type = self.msg.get('Content-type')
+        if content_type:
+            match = _CHARSET_RE.search(content_type)
+            if match:
+                return match.group(1)
+        return None
 
     def unicode(self, header):
         """Converts a header to unicode"""
         value = self.msg[header]
-        parts = decode_header(value)
-        return ''.join(
-            decoded_part.decode(codec)
-            if codec is not None else decoded_part.decode('ascii')
-            for decoded_part, codec in parts)
+        if value is None:
+            return u''
+        if isinstance(value, Header):
+            # headers containing raw 8-bit bytes are parsed into Header
+            # objects; get the bytes back and guess that they are utf-8
+            value = b''.join(
+                chunk for chunk, _ in decode_header(value)
+            ).decode('utf8', 'replace')
+        return _decode_header(value)
 
 
 @implementer(imap4.IMessage)
 class Message(MessagePart):
 
+    __slots__ = ('uid', 'flags', 'date', '_data', '_payloads', '_from', '_to')
+
     def __init__(self, fp, flags, date):
-        # email.message_from_binary_file is new in Python 3.3,
-        # and we need to use it if we are on Python3.
-        if hasattr(email, 'message_from_binary_file'):
-            parsed_message = email.message_from_binary_file(fp)
-        else:
-            parsed_message = email.message_from_file(fp)
-        super(Message, self).__init__(parsed_message)
-        self.data = str(self.msg)
+        raw = fp.read()
+        super(Message, self).__init__(message_from_bytes(raw))
+        # RFC822.SIZE is the size of the message as received, so record it
+        # now rather than re-serialising the parsed message on every FETCH.
+        self._size = len(raw)
+        self._data = None
+        self._payloads = None
+        # only used for __repr__, which gets called a lot when logging
+        self._from = self.msg.get('From', '')
+        self._to = self.msg.get('To', '')
         self.uid = get_counter()
         self.flags = set(flags)
         self.date = date
@@ -256,14 +433,21 @@ class Message(MessagePart):
     def getInternalDate(self):
         return self.date
 
+    @property
+    def data(self):
+        # only serialised on demand, nothing on the delivery path needs it
+        if self._data is None:
+            self._data = self.msg.as_string()
+        return self._data
+
     def __repr__(self):
-        h = self.getHeaders(False, 'From', 'To')
-        return "<From: %s, To: %s, Uid: %s>" % (h['from'], h['to'], self.uid)
+        return "<From: %s, To: %s, Uid: %s>" % (self._from, self._to, self.uid)
 
     def payloads(self):
-        for part in self.msg.walk():
-            if part.get_content_maintype() == 'multipart':
-                continue
-            payload = part.get_payload(decode=True)
+        if self._payloads is None:
             enc = self.parse_charset()
-            yield payload.decode(enc)
+            self._payloads = [
+                part.get_payload(decode=True).decode(enc)
+                for part in self.msg.walk()
+                if part.get_content_maintype() != 'multipart']
+        return iter(self._payloads)
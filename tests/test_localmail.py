@@ -2,6 +2,9 @@
 
 import os
 import time
+import shutil
+import mailbox
+import tempfile
 import threading
 import imaplib
 import smtplib
@@ -10,17 +13,24 @@ from email.charset import Charset, BASE64, QP
 from email.message import Message
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-from email.header import decode_header
+from email.header import Header, decode_header
 try:
     from email.generator import BytesGenerator as Generator
 except ImportError:
     from email.generator import Generator
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    ThreadPoolExecutor = None
 try:
     import unittest2 as unittest
 except ImportError:
     import unittest  # NOQA
 
+from twisted.internet import task
+
 import localmail
+from localmail import inbox
 
 from .helpers import (
     SMTPClient,
@@ -183,6 +193,39 @@ class SequentialIdTestCase(BaseLocalmailTestcase):
             [self.imap.msgid(2)]
         )
 
+    def test_store_sequence_number_out_of_range(self):
+        self.smtp.send(self._testmsg(1))
+        with self.assertRaises(imaplib.IMAP4.error):
+            self.imap.client.store('99', '+FLAGS', r'(\Deleted)')
+        self.assertEqual(self.imap.search('(DELETED)'), [])
+
+    def test_store_multiple_ranges(self):
+        for n in range(1, 6):
+            self.smtp.send(self._testmsg(n))
+        self.imap.client.store('2,4:*', '+FLAGS', r'(\Deleted)')
+        self.assertEqual(
+            self.imap.search('(DELETED)'),
+            [self.imap.msgid(n) for n in (2, 4, 5)]
+        )
+
+    def assert_status(self, recent, unseen):
+        success, data = self.imap.client.status('INBOX', '(RECENT UNSEEN)')
+        self.assertEqual(success, 'OK')
+        expected = 'INBOX (RECENT %d UNSEEN %d)' % (recent, unseen)
+        self.assertEqual(data[0].decode('ascii'), expected)
+
+    def test_status_counts(self):
+        self.smtp.send(self._testmsg(1))
+        self.smtp.send(self._testmsg(2))
+        self.assert_status(2, 2)
+        self.imap.store(1, r'(\Unseen)', '-FLAGS')
+        self.assert_status(2, 1)
+        self.imap.store(1, r'(\Seen)', 'FLAGS')
+        self.assert_status(1, 1)
+        self.imap.store(2, r'(\Deleted)')
+        self.imap.client.expunge()
+        self.assert_status(0, 0)
+
 
 class UidTestCase(SequentialIdTestCase):
     uid = True
@@ -219,8 +262,22 @@ class EncodingTestCase(BaseLocalmailTestcase):
         .encode('latin-1', 'ignore')\
         .decode('latin-1')
 
+    # (payload, charset, cte) for each test_roundtrip_* case below
+    roundtrips = [
+        (difficult_chars_latin1_compatible, 'iso-8859-1', '8bit'),
+        (difficult_chars, 'utf-8', '8bit'),
+        (difficult_chars, 'utf-8', 'quoted-printable'),
+        (difficult_chars, 'utf-8', 'base64'),
+    ]
+
     uid = False
 
+    @classmethod
+    def setUpClass(cls):
+        super(EncodingTestCase, cls).setUpClass()
+        # (text, charset, cte) -> (message, encoded message)
+        cls._fixtures = {}
+
     def setUp(self):
         super(EncodingTestCase, self).setUp()
         self.smtp = SMTPClient(HOST, SMTP_PORT)
@@ -252,31 +309,65 @@ class EncodingTestCase(BaseLocalmailTestcase):
         self.assertEqual(msg['Content-Transfer-Encoding'], cte)
         return msg
 
-    def _fetch_and_delete_sole_message(self):
-        message_number = None
+    def _make_fixture(self, text, charset, cte):
+        "returns a shared (message, encoded message) pair, don't modify it"
+        key = (text, charset, cte)
+        if key not in self._fixtures:
+            msg = self._make_message(text, charset, cte)
+            self._fixtures[key] = (msg, self._encode_message(msg))
+        return self._fixtures[key]
+
+    def _wait_for_sole_message(self):
+        if 'LOCALMAIL' not in os.environ:
+            # the server is running in this process, so wait for the
+            # delivery (cleared before sending) rather than sleeping
+            inbox.INBOX.new_message.wait(2.5)
         for _ in range(5):
             try:
                 message_number, = self.imap.search('ALL')
-                break
+                return message_number
             except ValueError:
                 time.sleep(0.5)
-        else:
-            raise AssertionError("Single Message not found")
+        raise AssertionError("Single Message not found")
+
+    def _fetch_and_delete_sole_message(self):
+        message_number = self._wait_for_sole_message()
         msg = self.imap.fetch(message_number)
         self.imap.store(message_number, r'(\Deleted)')
         self.imap.client.expunge()
         return msg
 
+    def _roundtrip(self, msg_id, payload, charset, cte):
+        "send and fetch back a message using connections of its own"
+        msg, encoded = self._make_fixture(payload, charset, cte)
+        header = 'Message-ID: <%s@example.com>\n' % msg_id
+        encoded = header.encode('ascii') + encoded
+        with SMTPClient(HOST, SMTP_PORT) as smtp:
+            smtp.client.sendmail(msg['From'], msg['To'], encoded)
+        with IMAPClient(HOST, IMAP_PORT) as imap:
+            # other messages may be in flight, so pick ours out by its id.
+            # Nothing is marked deleted here, since closing the mailbox would
+            # expunge it and renumber the messages under the other
+            # roundtrips; clean_inbox removes them all afterwards.
+            for message_number in imap.search('ALL'):
+                received = imap.fetch(message_number)
+                if received['Message-ID'] == '<%s@example.com>' % msg_id:
+                    return received
+        raise AssertionError("Message %s not found" % msg_id)
+
     def _do_test(self, payload, charset, cte):
         # Arrange
-        msg = self._make_message(payload, charset, cte)
-        encoded = self._encode_message(msg)
+        msg, encoded = self._make_fixture(payload, charset, cte)
 
         # Act
+        inbox.INBOX.new_message.clear()
         self.smtp.client.sendmail(msg['From'], msg['To'], encoded)
         received = self._fetch_and_delete_sole_message()
 
         # Assert
+        self._assert_roundtrip(received, payload, charset, cte)
+
+    def _assert_roundtrip(self, received, payload, charset, cte):
         payload_bytes = received.get_payload(decode=True)
         payload_text = payload_bytes.decode(received.get_content_charset())
         self.assertEqual(received['Content-Transfer-Encoding'], cte)
@@ -293,8 +384,7 @@ class EncodingTestCase(BaseLocalmailTestcase):
 
         (8-bit MIME)
         """
-        self._do_test(self.difficult_chars_latin1_compatible,
-                      'iso-8859-1', '8bit')
+        self._do_test(*self.roundtrips[0])
 
     def test_roundtrip_utf8_mail(self):
         """
@@ -302,16 +392,173 @@ class EncodingTestCase(BaseLocalmailTestcase):
 
         (8-bit MIME)
         """
-        self._do_test(self.difficult_chars, 'utf-8', '8bit')
+        self._do_test(*self.roundtrips[1])
 
     def test_roundtrip_utf8_qp_mail(self):
         """
         Mail can be sent in utf-8 in quoted printable format
         """
-        self._do_test(self.difficult_chars, 'utf-8', 'quoted-printable')
+        self._do_test(*self.roundtrips[2])
 
     def test_roundtrip_utf8_base64_mail(self):
         """
         Mail can be sent in utf-8 in quoted printable format
         """
-        self._do_test(self.difficult_chars, 'utf-8', 'base64')
+        self._do_test(*self.roundtrips[3])
+
+    @unittest.skipIf(ThreadPoolExecutor is None,
+                     "concurrent.futures not available")
+    def test_roundtrip_concurrently(self):
+        """
+        Mail in each of the above encodings can be sent at the same time
+        """
+        with ThreadPoolExecutor(max_workers=len(self.roundtrips)) as pool:
+            results = [
+                pool.submit(self._roundtrip, 'roundtrip%d' % n, *roundtrip)
+                for n, roundtrip in enumerate(self.roundtrips)]
+            for roundtrip, result in zip(self.roundtrips, results):
+                self._assert_roundtrip(result.result(), *roundtrip)
+
+
+class HeaderDecodingTestCase(unittest.TestCase):
+
+    def _unicode(self, header, value):
+        raw = ('%s: %s\n\nbody\n' % (header, value)).encode('ascii')
+        return inbox.Message(BytesIO(raw), [], None).unicode(header)
+
+    def test_plain_header(self):
+        self.assertEqual(self._unicode('Subject', 'plain text'), u'plain text')
+
+    def test_missing_header(self):
+        msg = inbox.Message(BytesIO(b'Subject: x\n\nbody\n'), [], None)
+        self.assertEqual(msg.unicode('To'), u'')
+
+    def test_base64_word(self):
+        value = Header(EncodingTestCase.difficult_chars, 'utf-8').encode()
+        self.assertEqual(self._unicode('Subject', value),
+                         EncodingTestCase.difficult_chars)
+
+    def test_quoted_printable_word(self):
+        value = u'caf\xe9 au lait'
+        encoded = Header(value, 'iso-8859-1').encode()
+        self.assertIn('?q?', encoded.lower())
+        self.assertEqual(self._unicode('Subject', encoded), value)
+
+    def test_mixed_words(self):
+        value = ('Re: =?utf-8?q?caf=C3=A9?= =?utf-8?b?4piD?= '
+                 '=?utf-8?q?_ok?= end')
+        self.assertEqual(self._unicode('Subject', value),
+                         u'Re: caf\xe9\u2603 ok end')
+
+    def test_raw_8bit_header(self):
+        raw = u'Subject: caf\xe9 =?utf-8?q?au_lait?=\n\nbody\n'
+        msg = inbox.Message(BytesIO(raw.encode('utf-8')), [], None)
+        self.assertEqual(msg.unicode('Subject'), u'caf\xe9 au lait')
+
+    def test_unknown_charset(self):
+        value = '=?x-unknown?q?abc?='
+        self.assertEqual(self._unicode('Subject', value), value)
+
+
+class FakeReactor(task.Clock):
+    "a Clock that also records system event triggers"
+
+    def __init__(self):
+        task.Clock.__init__(self)
+        self.triggers = []
+
+    def addSystemEventTrigger(self, phase, event, f, *args, **kwargs):
+        self.triggers.append((phase, event, f))
+
+
+class MboxFlushTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(MboxFlushTestCase, self).setUp()
+        self.clock = FakeReactor()
+        self.addCleanup(setattr, inbox, 'reactor', inbox.reactor)
+        inbox.reactor = self.clock
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.path = os.path.join(tmpdir, 'mbox')
+        self.mailbox = inbox.MemoryIMAPMailbox()
+        self.mailbox.setFile(self.path)
+        # count the syncs of the mbox file
+        self.flushes = []
+        mbox = self.mailbox.mbox
+        flush = mbox.flush
+
+        def counting_flush():
+            self.flushes.append(None)
+            flush()
+        mbox.flush = counting_flush
+
+    def deliver(self, n):
+        msg = ('Subject: %d\n\nbody\n' % n).encode('ascii')
+        self.mailbox.addMessage(BytesIO(msg))
+
+    def written(self):
+        return [msg['Subject'] for msg in mailbox.mbox(self.path)]
+
+    def test_flush_is_delayed(self):
+        for n in range(3):
+            self.deliver(n)
+        self.assertEqual(self.written(), [])
+        self.clock.advance(self.mailbox.flush_delay / 2)
+        self.assertEqual(self.written(), [])
+        self.clock.advance(self.mailbox.flush_delay / 2)
+        self.assertEqual(self.written(), ['0', '1', '2'])
+        self.assertEqual(len(self.flushes), 1)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_expunge_cancels_delayed_flush(self):
+        self.deliver(0)
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        self.mailbox.expunge()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertEqual(self.written(), ['0'])
+        self.clock.advance(self.mailbox.flush_delay)
+        self.assertEqual(len(self.flushes), 1)
+
+    def test_burst_written_under_one_lock(self):
+        locks = []
+        mbox = self.mailbox.mbox
+        lock = mbox.lock
+
+        def counting_lock():
+            locks.append(None)
+            lock()
+        mbox.lock = counting_lock
+        for n in range(3):
+            self.deliver(n)
+        self.clock.advance(self.mailbox.flush_delay)
+        self.assertEqual(self.written(), ['0', '1', '2'])
+        self.assertEqual(len(locks), 1)
+
+    def test_direct_flush_writes_everything_queued(self):
+        for n in range(3):
+            self.deliver(n)
+        self.mailbox.flush()
+        self.assertEqual(self.written(), ['0', '1', '2'])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_failed_flush_does_not_duplicate(self):
+        mbox = self.mailbox.mbox
+        add = mbox.add
+        calls = []
+
+        def failing_add(msg):
+            calls.append(None)
+            if len(calls) == 2:
+                raise IOError("disk full")
+            return add(msg)
+        mbox.add = failing_add
+        for n in range(3):
+            self.deliver(n)
+        self.assertRaises(IOError, self.mailbox.flush)
+        self.mailbox.flush()
+        self.assertEqual(self.written(), ['0', '1', '2'])
+
+    def test_flush_on_shutdown(self):
+        self.assertEqual(self.clock.triggers,
+                         [('before', 'shutdown', self.mailbox.flush)])